@@ -1,19 +1,64 @@
 import argparse
+import functools
 import logging
+import os
 import shutil
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import glob
+from typing import Optional
 
-import pyexiv2
+import jpeg_xmp
+
+log = logging.getLogger(__name__)
+
+GCAMERA_NAMESPACE = 'http://ns.google.com/photos/1.0/camera/'
+XMP_MICRO_VIDEO = 'Xmp.GCamera.MicroVideo'
+XMP_MICRO_VIDEO_VERSION = 'Xmp.GCamera.MicroVideoVersion'
+XMP_MICRO_VIDEO_OFFSET = 'Xmp.GCamera.MicroVideoOffset'
+XMP_MICRO_VIDEO_TIMESTAMP = 'Xmp.GCamera.MicroVideoPresentationTimestampUs'
+# In Apple Live Photos, the chosen photo is 1.5s after the start of the video, so 1500000 microseconds
+MICRO_VIDEO_TIMESTAMP_US = 1500000
+
+PHOTO_EXTENSIONS = frozenset({'.jpg', '.jpeg'})
+VIDEO_EXTENSIONS = frozenset({'.mov', '.mp4'})
+# When one photo has several videos (IMG.mov and IMG.MOV on a case-sensitive filesystem), the first of these wins.
+# Other case variants come after them.
+VIDEO_EXTENSION_PRIORITY = ('.mov', '.mp4', '.MOV', '.MP4')
+
+# Chunk size for copies that go through userspace. Big enough to keep readahead busy, small enough to not matter
+# for memory use on small devices.
+COPY_BUFFER_SIZE = 1024 * 1024
+copy_buffers = threading.local()
+
+@functools.lru_cache(maxsize=None)
+def load_pyexiv2():
+    """
+    Imports py3exiv2 the first time it's needed. It loads the whole exiv2 C++ library, and is only needed for photos
+    that already have XMP metadata jpeg_xmp can't safely add to, so most runs never pay for it.
+    :return: the pyexiv2 module, or None if it isn't installed
+    """
+    try:
+        import pyexiv2
+    except ImportError:
+        return None
+
+    # The namespace only needs registering once per process. (py)exiv2 raises a KeyError here on basically all my
+    # 'test' iPhone 13 photos -- I'm not sure why, but it seems safe to ignore so far.
+    try:
+        pyexiv2.xmp.register_namespace(GCAMERA_NAMESPACE, 'GCamera')
+    except KeyError:
+        pass
+    return pyexiv2
 
 def validate_directory(dir: Path):
     
     if not dir.exists():
-        logging.error("Path doesn't exist: {}".format(dir))
+        log.error("Path doesn't exist: %s", dir)
         exit(1)
     if not dir.is_dir():
-        logging.error("Path is not a directory: {}".format(dir))
+        log.error("Path is not a directory: %s", dir)
         exit(1)
 
 def validate_media(photo_path: Path, video_path: Path):
@@ -25,62 +70,168 @@ def validate_media(photo_path: Path, video_path: Path):
     :return: True if photo and video files are valid, else False
     """
     if not photo_path.exists():
-        logging.error("Photo does not exist: {}".format(photo_path))
+        log.error("Photo does not exist: %s", photo_path)
         return False
     if not video_path.exists():
-        logging.error("Video does not exist: {}".format(video_path))
+        log.error("Video does not exist: %s", video_path)
         return False
-    if not photo_path.suffix.lower() in ['.jpg', '.jpeg']:
-        logging.error("Photo isn't a JPEG: {}".format(photo_path))
+    if photo_path.suffix.lower() not in PHOTO_EXTENSIONS:
+        log.error("Photo isn't a JPEG: %s", photo_path)
         return False
-    if not video_path.suffix.lower() in ['.mov', '.mp4']:
-        logging.error("Video isn't a MOV or MP4: {}".format(photo_path))
+    if video_path.suffix.lower() not in VIDEO_EXTENSIONS:
+        log.error("Video isn't a MOV or MP4: %s", video_path)
         return False
     return True
 
-def merge_files(photo_path: Path, video_path: Path, output_path: Path) -> Path:
-    """Merges the photo and video file together by concatenating the video at the end of the photo. Writes the output to
-    a temporary folder.
+def copy_buffer() -> memoryview:
+    """Gets the calling thread's buffer for userspace copies, so chunks are read into the same memory every time
+    instead of being allocated per read. Each thread gets its own since conversions run concurrently.
+    :return: A writable memoryview of COPY_BUFFER_SIZE bytes
+    """
+    buffer = getattr(copy_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = copy_buffers.buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    return buffer
+
+def copy_file(src, dst):
+    """Copies the rest of an open source file, from its current position, to the current position of an open
+    destination file. Uses copy_file_range(2) where possible, which can share extents on filesystems that support
+    reflinks, then the kernel's zero-copy sendfile(2), and falls back to a chunked userspace copy.
+    :param src: source file opened in binary read mode
+    :param dst: destination file opened in binary write mode
+    """
+    size = os.fstat(src.fileno()).st_size
+    position = src.tell()
+    dst.flush()
+    start = dst.tell()
+    offset = position
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            # Older kernels refuse to copy across filesystems, and some filesystems don't support it at all.
+            log.info("copy_file_range not supported, falling back to sendfile.")
+
+    try:
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except (AttributeError, OSError):
+        # os.sendfile doesn't exist on Windows, and some filesystems don't support it.
+        log.info("sendfile not supported, falling back to a buffered copy.")
+
+    # Pick up wherever the kernel copies left off, so a failure part way through doesn't copy anything twice.
+    dst.seek(start + offset - position)
+    if offset < size:
+        src.seek(offset)
+        buffer = copy_buffer()
+        while True:
+            read = src.readinto(buffer)
+            if not read:
+                break
+            dst.write(buffer[:read])
+
+
+def advise(files, advice: str):
+    """Hints to the kernel how open files are about to be accessed, on platforms that have posix_fadvise.
+    :param files: files to give the hint for, in full
+    :param advice: name of the os.POSIX_FADV_* constant to pass
+    :return: None
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for file in files:
+        try:
+            os.posix_fadvise(file.fileno(), 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def merge_files(photo_path: Path, video_path: Path, output_path: Path) -> Optional[Path]:
+    """Merges the photo and video file together by concatenating the video at the end of the photo, and adds the XMP
+    metadata pointing at the video. Writes the output to a temporary folder.
     :param photo_path: Path to the photo
     :param video_path: Path to the video
-    :return: File name of the merged output file
+    :return: File name of the merged output file, or None if the XMP metadata couldn't be added
     """
-    logging.info("Merging {} and {}.".format(photo_path, video_path))
+    log.info("Merging %s and %s.", photo_path, video_path)
     out_path = output_path / photo_path.name
+    # Written next to out_path and moved over it once it's complete, so a failed conversion never truncates or
+    # deletes an output that's already there (like one from an earlier photo with the same name).
+    part_path = out_path.with_name(out_path.name + '.part')
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(out_path, "wb") as outfile, open(photo_path, "rb") as photo, open(video_path, "rb") as video:
-        outfile.write(photo.read())
-        outfile.write(video.read())
-    logging.info("Merged photo and video.")
+    with open(photo_path, "rb") as photo, open(video_path, "rb") as video:
+        # The 'offset' field in the XMP metadata should be the offset (in bytes) from the end of the file to the part
+        # where the video portion of the merged file begins. Since the video is appended last, that's just its size.
+        video_size = os.fstat(video.fileno()).st_size
+        # Both inputs are read start to end exactly once, so ask for more aggressive readahead, and drop them from the
+        # page cache afterwards so a big batch doesn't push everything else out of it.
+        advise((photo, video), 'POSIX_FADV_SEQUENTIAL')
+
+        # Write the XMP metadata while copying the photo instead of having exiv2 rewrite the whole merged file
+        # afterwards.
+        with open(part_path, "wb") as outfile:
+            if jpeg_xmp.inject_xmp(photo, outfile, GCAMERA_NAMESPACE, 'GCamera', {
+                'MicroVideo': 1,
+                'MicroVideoVersion': 1,
+                'MicroVideoOffset': video_size,
+                'MicroVideoPresentationTimestampUs': MICRO_VIDEO_TIMESTAMP_US,
+            }):
+                copy_file(photo, outfile)
+            else:
+                photo_with_xmp = None
+                if load_pyexiv2() is None:
+                    log.error("py3exiv2 is needed to add Motion Photo metadata to %s.", photo_path)
+                else:
+                    try:
+                        photo_with_xmp = add_xmp_metadata(photo.read(), video_size)
+                    except (OSError, ValueError) as e:
+                        # py3exiv2 turns exiv2's errors (empty files, unknown image types, corrupt metadata) into
+                        # these.
+                        log.error("Couldn't add Motion Photo metadata to %s: %s", photo_path, e)
+                if photo_with_xmp is None:
+                    outfile.close()
+                    part_path.unlink()
+                    return None
+                outfile.write(photo_with_xmp)
+            copy_file(video, outfile)
+        advise((photo, video), 'POSIX_FADV_DONTNEED')
+    os.replace(str(part_path), str(out_path))
+    log.info("Merged photo and video.")
     return out_path
 
 
-def add_xmp_metadata(merged_file: Path, offset: int):
-    """Adds XMP metadata to the merged image indicating the byte offset in the file where the video begins.
-    :param merged_file: The path to the file that has the photo and video merged together.
+def add_xmp_metadata(photo: bytes, offset: int) -> bytes:
+    """Adds XMP metadata to the image indicating the byte offset in the file where the video begins. exiv2 works on
+    an in-memory copy of the photo, so no file on disk gets rewritten.
+    :param photo: The contents of the photo the video will be merged into.
     :param offset: The number of bytes from EOF to the beginning of the video.
-    :return: None
+    :return: The photo with the metadata added
     """
-    metadata = pyexiv2.ImageMetadata(str(merged_file.resolve()))
-    logging.info("Reading existing metadata from file.")
+    pyexiv2 = load_pyexiv2()
+    metadata = pyexiv2.ImageMetadata.from_buffer(photo)
+    log.info("Reading existing metadata from photo.")
+    # exiv2 won't write metadata that hasn't been read first, so the read can't be skipped, but listing the keys
+    # builds a new list each time and is only needed for the log messages, so skip it when they won't be shown.
     metadata.read()
-    logging.info("Found XMP keys: " + str(metadata.xmp_keys))
-    if len(metadata.xmp_keys) > 0:
-        logging.warning("Found existing XMP keys. They *may* be affected after this process.")
+    if log.isEnabledFor(logging.WARNING):
+        xmp_keys = metadata.xmp_keys
+        log.info("Found XMP keys: %s", xmp_keys)
+        if len(xmp_keys) > 0:
+            log.warning("Found existing XMP keys. They *may* be affected after this process.")
 
-    # (py)exiv2 raises an exception here on basically all my 'test' iPhone 13 photos -- I'm not sure why,
-    # but it seems safe to ignore so far. It's logged anyways just in case.
-    try:
-        pyexiv2.xmp.register_namespace('http://ns.google.com/photos/1.0/camera/', 'GCamera')
-    except KeyError:
-        logging.warning("exiv2 detected that the GCamera namespace already exists.".format(merged_file))
-    metadata['Xmp.GCamera.MicroVideo'] = pyexiv2.XmpTag('Xmp.GCamera.MicroVideo', 1)
-    metadata['Xmp.GCamera.MicroVideoVersion'] = pyexiv2.XmpTag('Xmp.GCamera.MicroVideoVersion', 1)
-    metadata['Xmp.GCamera.MicroVideoOffset'] = pyexiv2.XmpTag('Xmp.GCamera.MicroVideoOffset', offset)
-    metadata['Xmp.GCamera.MicroVideoPresentationTimestampUs'] = pyexiv2.XmpTag(
-        'Xmp.GCamera.MicroVideoPresentationTimestampUs',
-        1500000)  # in Apple Live Photos, the chosen photo is 1.5s after the start of the video, so 1500000 microseconds
+    metadata[XMP_MICRO_VIDEO] = pyexiv2.XmpTag(XMP_MICRO_VIDEO, 1)
+    metadata[XMP_MICRO_VIDEO_VERSION] = pyexiv2.XmpTag(XMP_MICRO_VIDEO_VERSION, 1)
+    metadata[XMP_MICRO_VIDEO_OFFSET] = pyexiv2.XmpTag(XMP_MICRO_VIDEO_OFFSET, offset)
+    metadata[XMP_MICRO_VIDEO_TIMESTAMP] = pyexiv2.XmpTag(XMP_MICRO_VIDEO_TIMESTAMP, MICRO_VIDEO_TIMESTAMP_US)
     metadata.write()
+    return metadata.buffer
 
 
 def convert(photo_path: Path, video_path: Path, output_path: Path):
@@ -90,25 +241,57 @@ def convert(photo_path: Path, video_path: Path, output_path: Path):
     :param video_path: path to the video to merge
     :return: True if conversion was successful, else False
     """
-    merged = merge_files(photo_path, video_path, output_path)
-    photo_filesize = photo_path.stat().st_size
-    merged_filesize = merged.stat().st_size
-
-    # The 'offset' field in the XMP metadata should be the offset (in bytes) from the end of the file to the part
-    # where the video portion of the merged file begins. In other words, merged size - photo_only_size = offset.
-    offset = merged_filesize - photo_filesize
-    add_xmp_metadata(merged, offset)
-
-def matching_video(photo_path: Path) -> Path:
-    base = str(photo_path.with_suffix(""))
-    logging.info("Looking for videos named: {}".format(base))
-    files = set(glob.glob(base + ".*"))
-    print
-    for ext in (".mov", ".mp4", ".MOV", ".MP4"):
-        if base + ext in files:
-            return Path(base + ext)
+    return merge_files(photo_path, video_path, output_path) is not None
+
+def index_directory(directory, dir_fd: Optional[int] = None) -> dict:
+    """
+    Lists a directory once and groups its photos and videos by name without extension, so they can be paired up
+    with dictionary lookups instead of checking the filesystem for every candidate video.
+    :param directory: directory to index
+    :param dir_fd: optional open file descriptor of the directory, which is listed instead of resolving its path again
+    :return: a dict mapping each file's base name to a dict of {extension: os.DirEntry}. Extensions keep their
+    case, so IMG.jpg and IMG.JPG on a case-sensitive filesystem don't replace each other.
+    """
+    stems = {}
+    with os.scandir(directory if dir_fd is None else dir_fd) as entries:
+        for entry in entries:
+            base, ext = os.path.splitext(entry.name)
+            lower_ext = ext.lower()
+            # Check the name first, is_file() may need a stat() on filesystems that don't report file types.
+            if (lower_ext in PHOTO_EXTENSIONS or lower_ext in VIDEO_EXTENSIONS) and entry.is_file():
+                stems.setdefault(base, {})[ext] = entry
+    return stems
+
+
+def video_priority(ext: str):
+    """Sort key putting video extensions in the order they're preferred in when a photo has several videos.
+    :param ext: a video file extension, with its original case
+    :return: a key that sorts VIDEO_EXTENSION_PRIORITY first, in its order, then any other case variants
+    """
+    if ext in VIDEO_EXTENSION_PRIORITY:
+        return VIDEO_EXTENSION_PRIORITY.index(ext), ext
+    return len(VIDEO_EXTENSION_PRIORITY), ext
+
+def walk_directories(file_dir: Path, recurse: bool):
+    """
+    Yields every directory that should be searched for photos/videos, along with an open file descriptor for it when
+    the platform supports os.fwalk.
+    :param file_dir: top level directory to search
+    :param recurse: if true, subdirectories are yielded too
+    :return: a generator of (directory path, directory fd or None) tuples
+    """
+    if not recurse:
+        yield str(file_dir), None
+    elif hasattr(os, 'fwalk'):
+        # fwalk keeps each directory open while it's being visited, so listing it by fd doesn't make the kernel walk
+        # the full path again for every level of a deep tree. Without following symlinks it skips a top directory
+        # that is one, unlike rglob did; the trailing slash makes the kernel resolve just that one. Symlinked
+        # subdirectories still aren't followed.
+        for dirpath, _, _, dir_fd in os.fwalk(os.path.join(str(file_dir), '')):
+            yield dirpath, dir_fd
     else:
-        return Path("")
+        for dirpath, _, _ in os.walk(file_dir):
+            yield dirpath, None
 
 def process_directory(file_dir: Path, recurse: bool):
     """
@@ -116,25 +299,35 @@ def process_directory(file_dir: Path, recurse: bool):
     be converted
     :param file_dir: directory to look for photos/videos to convert
     :param recurse: if true, subdirectories will recursively be processes
-    :return: a list of tuples containing matched photo/video pairs.
+    :return: a list of tuples containing matched photo/video pairs, as plain string paths.
     """
-    logging.info("Processing dir: {}".format(file_dir))
+    log.info("Processing dir: %s", file_dir)
 
     file_pairs = []
-    files = file_dir.rglob("*") if recurse else file_dir.iterdir()
-    for file in files:
-        if file.is_file() and file.suffix.lower() in ['.jpg', '.jpeg'] and matching_video(file) != Path(""):
-            file_pairs.append((file, matching_video(file)))
+    for directory, dir_fd in walk_directories(file_dir, recurse):
+        for files in index_directory(directory, dir_fd).values():
+            videos = sorted((ext for ext in files if ext.lower() in VIDEO_EXTENSIONS), key=video_priority)
+            if not videos:
+                continue
+            video = files[videos[0]]
+            photos = [entry for ext, entry in files.items() if ext.lower() in PHOTO_EXTENSIONS]
+            if photos and len(videos) > 1:
+                log.warning("Found several videos for %s, using %s and ignoring %s.",
+                            os.path.join(directory, photos[0].name), video.name,
+                            [files[ext].name for ext in videos[1:]])
+            # Every photo gets paired, like before, even if several of them share the video.
+            for photo in photos:
+                file_pairs.append((os.path.join(directory, photo.name), os.path.join(directory, video.name)))
 
-    logging.info("Found {} pairs.".format(len(file_pairs)))
-    logging.info("subset of found image/video pairs: {}".format(str(file_pairs[0:9])))
+    log.info("Found %d pairs.", len(file_pairs))
+    log.info("subset of found image/video pairs: %s", file_pairs[0:9])
     return file_pairs
 
 
 def main(args):
     logging_level = logging.INFO if args.verbose else logging.ERROR
     logging.basicConfig(level=logging_level, stream=sys.stdout)
-    logging.info("Enabled verbose logging")
+    log.info("Enabled verbose logging")
 
     outdir = args.output if args.output is not None else Path("output")
 
@@ -142,34 +335,64 @@ def main(args):
         validate_directory(args.dir)
         pairs = process_directory(args.dir, args.recurse)
         procesed_files = set()
+        procesed_files_lock = threading.Lock()
+
+        def convert_pair(pair):
+            # Pairs are kept as strings while scanning, since building Path objects for every file adds up. They
+            # don't go through validate_media, process_directory only pairs up existing files with valid extensions.
+            # Pairs that fail to convert aren't marked as processed, so --copyall still copies them through as-is.
+            if convert(Path(pair[0]), Path(pair[1]), outdir):
+                with procesed_files_lock:
+                    procesed_files.add(pair[0])
+                    procesed_files.add(pair[1])
+
+        # Every photo is written to outdir under its own name, so with --recurse photos with the same name from
+        # different directories land on the same output path. Those are converted one after another by a single
+        # worker (the last one that converts wins, like it always has) so two workers never write the same file at
+        # once. Names are grouped case-insensitively, since outdir may be on a case-insensitive filesystem.
+        pairs_by_output = {}
         for pair in pairs:
-            if validate_media(pair[0], pair[1]):
-                convert(pair[0], pair[1], outdir)
-                procesed_files.add(pair[0])
-                procesed_files.add(pair[1])
-
-        if args.copyall:
-            # Copy the remaining files to outdir
-            all_files = set(file for file in args.dir.iterdir())
-            remaining_files = all_files - procesed_files
-
-            logging.info("Found {} remaining files that will copied.".format(len(remaining_files)))
-
-            if len(remaining_files) > 0:
-                # Ensure the destination directory exists
-                outdir.mkdir(parents=True, exist_ok=True)
-                
-                for file in remaining_files:
-                    file_name = file.name
-                    destination_path = outdir / file_name
-                    shutil.copy2(file, destination_path)
+            pairs_by_output.setdefault(os.path.basename(pair[0]).lower(), []).append(pair)
+        for same_output in pairs_by_output.values():
+            if len(same_output) < 2:
+                continue
+            photos = [pair[0] for pair in same_output]
+            if len({os.path.basename(photo) for photo in photos}) == 1:
+                log.warning("%d photos would be written to %s, only the last one will be kept: %s",
+                            len(same_output), outdir / os.path.basename(photos[-1]), photos)
+            else:
+                log.warning("%d photos have names that only differ in case, they may collide in %s: %s",
+                            len(same_output), outdir, photos)
+
+        def convert_pairs(same_output):
+            for pair in same_output:
+                convert_pair(pair)
+
+        # Each conversion is I/O bound and independent of the others, and exiv2 releases the GIL, so threads are
+        # enough to overlap the disk writes of several pairs.
+        with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2) as executor:
+            list(executor.map(convert_pairs, pairs_by_output.values()))
+
+            if args.copyall:
+                # Copy the remaining files to outdir. Subdirectories aren't files, so they're left out.
+                with os.scandir(args.dir) as entries:
+                    remaining_files = [entry for entry in entries
+                                       if entry.is_file() and entry.path not in procesed_files]
+
+                log.info("Found %d remaining files that will copied.", len(remaining_files))
+
+                if len(remaining_files) > 0:
+                    # Ensure the destination directory exists
+                    outdir.mkdir(parents=True, exist_ok=True)
+
+                    list(executor.map(lambda entry: shutil.copy2(entry.path, outdir / entry.name), remaining_files))
     else:
         if args.photo is None and args.video is None:
-            logging.error("Either --dir or --photo and --video are required.")
+            log.error("Either --dir or --photo and --video are required.")
             exit(1)
 
         if bool(args.photo) ^ bool(args.video):
-            logging.error("Both --photo and --video must be provided.")
+            log.error("Both --photo and --video must be provided.")
             exit(1)
 
         if validate_media(args.photo, args.video):
@@ -0,0 +1,166 @@
+import mmap
+import struct
+from typing import Optional, Tuple
+from xml.sax.saxutils import quoteattr
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_APP0 = 0xE0
+JPEG_APP1 = 0xE1
+JPEG_SOS = 0xDA
+# TEM and RST0-7 have no length field.
+JPEG_STANDALONE_MARKERS = frozenset({0x01} | set(range(0xD0, 0xD8)))
+XMP_SIGNATURE = b'http://ns.adobe.com/xap/1.0/\x00'
+# A segment's length field is 16 bits and counts itself.
+MAX_XMP_PACKET_SIZE = 0xFFFF - 2 - len(XMP_SIGNATURE)
+
+XMP_PACKET_TEMPLATE = (
+    '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+    ' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+    '  <rdf:Description rdf:about=""{attributes}/>\n'
+    ' </rdf:RDF>\n'
+    '</x:xmpmeta>\n'
+    '<?xpacket end="w"?>'
+)
+
+
+def find_xmp(data) -> Optional[Tuple[int, int, Optional[bytes]]]:
+    """Walks the marker segments at the start of a JPEG looking for its XMP APP1 segment.
+    :param data: the JPEG contents (bytes or mmap)
+    :return: (start, end, packet) of the existing XMP segment, or (position, position, None) with the position a new
+    segment should go at, right after the leading APP0 (JFIF) / APP1 (Exif) segments. None if it isn't a JPEG, or its
+    segments are truncated or malformed.
+    """
+    if data[:2] != JPEG_SOI:
+        return None
+
+    position = 2
+    insert_at = None
+    while position + 2 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        segment_start = position
+        # Any marker may be preceded by 0xFF fill bytes.
+        while position + 2 < len(data) and data[position + 1] == 0xFF:
+            position += 1
+        marker = data[position + 1]
+        if marker == JPEG_SOS:
+            if insert_at is None:
+                insert_at = segment_start
+            return insert_at, insert_at, None
+        if insert_at is None and marker not in (JPEG_APP0, JPEG_APP1):
+            insert_at = segment_start
+        if marker in JPEG_STANDALONE_MARKERS:
+            position += 2
+            continue
+
+        if position + 4 > len(data):
+            return None
+        length = struct.unpack_from('>H', data, position + 2)[0]
+        end = position + 2 + length
+        if length < 2 or end > len(data):
+            return None
+        packet_start = position + 4 + len(XMP_SIGNATURE)
+        if marker == JPEG_APP1 and packet_start <= end and data[position + 4:packet_start] == XMP_SIGNATURE:
+            return segment_start, end, data[packet_start:end]
+        position = end
+    return None
+
+
+def xmp_attributes(namespace: str, prefix: str, properties: dict) -> str:
+    """Formats XMP properties as attributes of an rdf:Description element.
+    :param namespace: URI of the namespace the properties belong to
+    :param prefix: XML prefix to use for the namespace
+    :param properties: property names (without prefix) to their values
+    :return: the attributes, each on its own indented line
+    """
+    attributes = ['xmlns:{}={}'.format(prefix, quoteattr(namespace))]
+    attributes += ['{}:{}={}'.format(prefix, name, quoteattr(str(value))) for name, value in properties.items()]
+    return ''.join('\n   ' + attribute for attribute in attributes)
+
+
+def add_to_xmp_packet(packet: bytes, namespace: str, prefix: str, properties: dict) -> Optional[bytes]:
+    """Adds properties to an existing XMP packet by putting them on its first rdf:Description element. This is not a
+    full XMP parser, so anything it isn't sure about is left for exiv2.
+    :param packet: the existing XMP packet
+    :param namespace: URI of the namespace the properties belong to
+    :param prefix: XML prefix to use for the namespace
+    :param properties: property names (without prefix) to their values
+    :return: the new packet, or None if the packet already uses the namespace or has no rdf:Description
+    """
+    try:
+        text = packet.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    if namespace in text or 'xmlns:{}='.format(prefix) in text:
+        return None
+    description = text.find('<rdf:Description')
+    if description < 0:
+        return None
+
+    insert_at = description + len('<rdf:Description')
+    attributes = xmp_attributes(namespace, prefix, properties)
+    text = text[:insert_at] + attributes + text[insert_at:]
+
+    # Packets usually end with whitespace padding so they can grow in place; use it up instead of growing the file.
+    trailer = text.rfind('<?xpacket end')
+    if trailer > 0:
+        padding = len(text[:trailer]) - len(text[:trailer].rstrip())
+        shrink = min(max(padding - 1, 0), len(attributes))
+        text = text[:trailer - shrink] + text[trailer:]
+    return text.encode('utf-8')
+
+
+def xmp_segment(packet: bytes) -> bytes:
+    """Wraps an XMP packet in an APP1 segment.
+    :param packet: the XMP packet
+    :return: the full APP1 segment, including its marker and length
+    """
+    payload = XMP_SIGNATURE + packet
+    return bytes([0xFF, JPEG_APP1]) + struct.pack('>H', 2 + len(payload)) + payload
+
+
+def inject_xmp(src, dst, namespace: str, prefix: str, properties: dict) -> bool:
+    """Writes the start of a JPEG to dst with the given XMP properties added, either to its existing XMP packet or to
+    a new APP1 segment. Only the marker segments are read, through mmap where the filesystem allows it, so the rest of
+    the file can be streamed afterwards by the caller.
+    :param src: the JPEG opened in binary read mode
+    :param dst: destination file opened in binary write mode
+    :param namespace: URI of the namespace the properties belong to
+    :param prefix: XML prefix to use for the namespace
+    :param properties: property names (without prefix) to their values
+    :return: True if the XMP was written and src is positioned at the rest of the JPEG to copy. False if nothing was
+    written, because src isn't a JPEG or its XMP can't be safely edited without exiv2; src is then left at the start.
+    """
+    src.seek(0)
+    try:
+        data = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty files can't be mapped.
+        return False
+    except OSError:
+        # Some filesystems can't be mapped at all (FUSE mounts can give ENODEV); photos are small enough to just read.
+        data = src.read()
+
+    try:
+        location = find_xmp(data)
+        if location is None:
+            return False
+        start, end, existing = location
+
+        if existing is None:
+            packet = XMP_PACKET_TEMPLATE.format(attributes=xmp_attributes(namespace, prefix, properties))
+            packet = packet.encode('utf-8')
+        else:
+            packet = add_to_xmp_packet(existing, namespace, prefix, properties)
+        if packet is None or len(packet) > MAX_XMP_PACKET_SIZE:
+            return False
+
+        dst.write(data[:start])
+        dst.write(xmp_segment(packet))
+    finally:
+        if not isinstance(data, bytes):
+            data.close()
+        src.seek(0)
+    src.seek(end)
+    return True
@@ -0,0 +1,188 @@
+import errno
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import MotionPhotoMuxer
+
+
+def touch(path: Path, data: bytes = b''):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def fail_after(function, count_arg: int, limit: int) -> mock.Mock:
+    """Wraps a kernel copy function so it copies at most limit bytes, in small calls, then fails like an unsupported
+    filesystem would.
+    :param count_arg: index of the byte count argument, 2 for copy_file_range and 3 for sendfile
+    """
+    copied = 0
+
+    def wrapper(*args):
+        nonlocal copied
+        if copied >= limit:
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        args = list(args)
+        args[count_arg] = min(args[count_arg], limit - copied, 1024)
+        result = function(*args)
+        copied += result
+        return result
+    return mock.Mock(side_effect=wrapper)
+
+
+class CopyFileTest(unittest.TestCase):
+    DATA = bytes(range(256)) * 40
+    PREFIX = b'already written'
+    START = 123
+
+    def setUp(self):
+        # Small chunks, so the userspace copy goes round its loop more than once.
+        patcher = mock.patch.multiple(MotionPhotoMuxer, COPY_BUFFER_SIZE=1000, copy_buffers=threading.local())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def copy(self) -> bytes:
+        with tempfile.TemporaryFile() as src, tempfile.TemporaryFile() as dst:
+            src.write(self.DATA)
+            src.seek(self.START)
+            # Left in dst's buffer, so copy_file has to flush it before the kernel copies write behind it.
+            dst.write(self.PREFIX)
+            MotionPhotoMuxer.copy_file(src, dst)
+            # merge_files copies twice into the same file, so dst's position must be kept in step with the kernel
+            # copies.
+            self.assertEqual(dst.tell(), len(self.PREFIX) + len(self.DATA) - self.START)
+            dst.write(b'end')
+            dst.seek(0)
+            return dst.read()
+
+    def assertCopied(self):
+        self.assertEqual(self.copy(), self.PREFIX + self.DATA[self.START:] + b'end')
+
+    def test_kernel_copies(self):
+        self.assertCopied()
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'), 'needs copy_file_range')
+    def test_copy_file_range_fails(self):
+        with mock.patch.object(os, 'copy_file_range', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')):
+            self.assertCopied()
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'), 'needs copy_file_range')
+    def test_copy_file_range_fails_part_way(self):
+        copy_file_range = fail_after(os.copy_file_range, 2, 5000)
+        with mock.patch.object(os, 'copy_file_range', copy_file_range):
+            self.assertCopied()
+        self.assertGreater(copy_file_range.call_count, 2)
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), 'needs sendfile')
+    def test_sendfile_fails_part_way(self):
+        sendfile = fail_after(os.sendfile, 3, 2500)
+        with mock.patch.object(os, 'copy_file_range', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'),
+                               create=True), \
+                mock.patch.object(os, 'sendfile', sendfile):
+            self.assertCopied()
+        self.assertGreater(sendfile.call_count, 2)
+
+    def test_kernel_copies_fail(self):
+        error = OSError(errno.EINVAL, 'Invalid argument')
+        with mock.patch.object(os, 'copy_file_range', side_effect=error, create=True), \
+                mock.patch.object(os, 'sendfile', side_effect=error, create=True):
+            self.assertCopied()
+
+    def test_kernel_copies_missing(self):
+        with mock.patch.dict(os.__dict__):
+            os.__dict__.pop('copy_file_range', None)
+            os.__dict__.pop('sendfile', None)
+            self.assertCopied()
+
+
+class ProcessDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = Path(self.tmp.name)
+
+    def pairs(self, directory: Path, recurse: bool) -> set:
+        return {(os.path.relpath(photo, str(directory)), os.path.relpath(video, str(directory)))
+                for photo, video in MotionPhotoMuxer.process_directory(directory, recurse)}
+
+    def test_pairs(self):
+        for name in ('IMG_1.JPG', 'IMG_1.MOV', 'IMG_2.jpeg', 'IMG_2.mp4', 'IMG_3.jpg', 'IMG_4.mov', 'notes.txt'):
+            touch(self.root / name)
+        (self.root / 'IMG_5.jpg').mkdir()
+        touch(self.root / 'IMG_5.mov')
+        self.assertEqual(self.pairs(self.root, False), {('IMG_1.JPG', 'IMG_1.MOV'), ('IMG_2.jpeg', 'IMG_2.mp4')})
+
+    def test_case_variants(self):
+        names = ('IMG.jpg', 'IMG.JPG', 'IMG.MP4', 'IMG.MOV', 'IMG.mp4')
+        for name in names:
+            touch(self.root / name)
+        if len(os.listdir(str(self.root))) < len(names):
+            self.skipTest('case-insensitive filesystem')
+        with self.assertLogs(MotionPhotoMuxer.log, 'WARNING'):
+            pairs = self.pairs(self.root, False)
+        # Same video priority as before: .mov, .mp4, .MOV, .MP4. Every photo is still paired.
+        self.assertEqual(pairs, {('IMG.jpg', 'IMG.mp4'), ('IMG.JPG', 'IMG.mp4')})
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'needs symlinks')
+    def test_recurse_into_symlinked_dir(self):
+        real = self.root / 'real'
+        touch(real / 'IMG_1.JPG')
+        touch(real / 'IMG_1.MOV')
+        touch(real / 'sub' / 'IMG_2.jpg')
+        touch(real / 'sub' / 'IMG_2.mp4')
+        touch(self.root / 'elsewhere' / 'IMG_3.jpg')
+        touch(self.root / 'elsewhere' / 'IMG_3.mov')
+        os.symlink(str(self.root / 'elsewhere'), str(real / 'sub' / 'linked'))
+        link = self.root / 'link'
+        os.symlink(str(real), str(link))
+
+        pairs = MotionPhotoMuxer.process_directory(link, True)
+        # Paths stay under the directory that was asked for, so --copyall can tell which of its files were converted.
+        self.assertIn((os.path.join(str(link), 'IMG_1.JPG'), os.path.join(str(link), 'IMG_1.MOV')), pairs)
+        # Symlinked subdirectories aren't followed.
+        self.assertEqual(self.pairs(link, True), {('IMG_1.JPG', 'IMG_1.MOV'),
+                                                  (os.path.join('sub', 'IMG_2.jpg'), os.path.join('sub', 'IMG_2.mp4'))})
+        self.assertEqual(self.pairs(link, False), {('IMG_1.JPG', 'IMG_1.MOV')})
+
+
+class MergeFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = Path(self.tmp.name)
+
+    def test_exiv2_failure_leaves_no_output(self):
+        touch(self.root / 'IMG.jpg', b'not a jpeg')
+        touch(self.root / 'IMG.mov', b'video')
+        pyexiv2 = mock.Mock()
+        pyexiv2.ImageMetadata.from_buffer.side_effect = OSError('The memory contains data of an unknown image type')
+        with mock.patch.object(MotionPhotoMuxer, 'load_pyexiv2', return_value=pyexiv2), \
+                self.assertLogs(MotionPhotoMuxer.log, 'ERROR'):
+            result = MotionPhotoMuxer.merge_files(self.root / 'IMG.jpg', self.root / 'IMG.mov', self.root / 'out')
+        self.assertIsNone(result)
+        self.assertEqual(list((self.root / 'out').iterdir()), [])
+
+    def test_failure_keeps_existing_output(self):
+        # A minimal JPEG jpeg_xmp can add to, then a photo with the same name that can't be converted.
+        touch(self.root / 'a' / 'IMG.jpg', b'\xff\xd8\xff\xda\x00\x02scan\xff\xd9')
+        touch(self.root / 'b' / 'IMG.jpg', b'not a jpeg')
+        touch(self.root / 'IMG.mov', b'video')
+        out = self.root / 'out'
+        merged = MotionPhotoMuxer.merge_files(self.root / 'a' / 'IMG.jpg', self.root / 'IMG.mov', out)
+        self.assertEqual(merged, out / 'IMG.jpg')
+        expected = merged.read_bytes()
+        with mock.patch.object(MotionPhotoMuxer, 'load_pyexiv2', return_value=None), \
+                self.assertLogs(MotionPhotoMuxer.log, 'ERROR'):
+            self.assertIsNone(MotionPhotoMuxer.merge_files(self.root / 'b' / 'IMG.jpg', self.root / 'IMG.mov', out))
+        self.assertEqual(list(out.iterdir()), [merged])
+        self.assertEqual(merged.read_bytes(), expected)
+        self.assertTrue(expected.endswith(b'video'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import errno
+import io
+import struct
+import tempfile
+import unittest
+import xml.dom.minidom
+from unittest import mock
+
+import jpeg_xmp
+
+NAMESPACE = 'http://ns.google.com/photos/1.0/camera/'
+PROPERTIES = {'MicroVideo': 1, 'MicroVideoOffset': 12345}
+
+
+def segment(marker: int, payload: bytes) -> bytes:
+    return bytes([0xFF, marker]) + struct.pack('>H', 2 + len(payload)) + payload
+
+
+JFIF = segment(0xE0, b'JFIF\x00' + b'\x01' * 9)
+EXIF = segment(0xE1, b'Exif\x00\x00' + b'abcd')
+DQT = segment(0xDB, b'\x00' * 65)
+SCAN = segment(0xDA, b'\x01\x01\x00\x00\x3f\x00') + b'\x12\x34\x56' + b'\xff\xd9'
+
+
+def jpeg(*segments: bytes) -> bytes:
+    return jpeg_xmp.JPEG_SOI + b''.join(segments) + SCAN
+
+
+def xmp_packet(description_attributes: str = '', padding: int = 0) -> bytes:
+    return ('<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+            '<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+            '<rdf:Description rdf:about="" xmlns:xmp="http://ns.adobe.com/xap/1.0/" xmp:Rating="3"'
+            + description_attributes + '/></rdf:RDF></x:xmpmeta>'
+            + ' ' * padding + '<?xpacket end="w"?>').encode('utf-8')
+
+
+class InjectXmpTest(unittest.TestCase):
+
+    def inject(self, data: bytes):
+        """Runs inject_xmp on data and copies the rest of the photo like merge_files does.
+        :return: (result, output bytes, src position right after inject_xmp)
+        """
+        with tempfile.TemporaryFile() as src:
+            src.write(data)
+            src.flush()
+            dst = io.BytesIO()
+            result = jpeg_xmp.inject_xmp(src, dst, NAMESPACE, 'GCamera', PROPERTIES)
+            position = src.tell()
+            dst.write(src.read())
+        return result, dst.getvalue(), position
+
+    def assertValidXmp(self, output: bytes) -> str:
+        location = jpeg_xmp.find_xmp(output)
+        self.assertIsNotNone(location)
+        packet = location[2].decode('utf-8')
+        xml.dom.minidom.parseString(packet[packet.index('<x:xmpmeta'):packet.index('<?xpacket end')].strip())
+        self.assertIn('GCamera:MicroVideoOffset="12345"', packet)
+        return packet
+
+    def test_new_segment_after_jfif_and_exif(self):
+        data = jpeg(JFIF, EXIF, DQT)
+        result, output, _ = self.inject(data)
+        self.assertTrue(result)
+        self.assertValidXmp(output)
+        start, end, _ = jpeg_xmp.find_xmp(output)
+        self.assertEqual(output[:start], jpeg_xmp.JPEG_SOI + JFIF + EXIF)
+        self.assertEqual(output[end:], DQT + SCAN)
+
+    def test_new_segment_without_app_segments(self):
+        result, output, _ = self.inject(jpeg(DQT))
+        self.assertTrue(result)
+        self.assertEqual(jpeg_xmp.find_xmp(output)[0], 2)
+        self.assertTrue(output.endswith(DQT + SCAN))
+
+    def test_fill_bytes_and_standalone_markers(self):
+        data = jpeg(JFIF, b'\xff\xff', DQT, b'\xff\xd0', b'\xff\x01')
+        result, output, _ = self.inject(data)
+        self.assertTrue(result)
+        self.assertValidXmp(output)
+        # The new segment goes in front of the fill bytes, which stay attached to the DQT marker.
+        self.assertTrue(output.endswith(b'\xff\xff' + DQT + b'\xff\xd0\xff\x01' + SCAN))
+
+    def test_existing_packet_after_dqt(self):
+        data = jpeg(JFIF, DQT, segment(0xE1, jpeg_xmp.XMP_SIGNATURE + xmp_packet()))
+        result, output, _ = self.inject(data)
+        self.assertTrue(result)
+        packet = self.assertValidXmp(output)
+        self.assertIn('xmp:Rating="3"', packet)
+        self.assertEqual(output.count(jpeg_xmp.XMP_SIGNATURE), 1)
+        self.assertTrue(output.startswith(jpeg_xmp.JPEG_SOI + JFIF + DQT))
+
+    def test_existing_packet_padding_is_used_up(self):
+        data = jpeg(JFIF, segment(0xE1, jpeg_xmp.XMP_SIGNATURE + xmp_packet(padding=2000)))
+        result, output, _ = self.inject(data)
+        self.assertTrue(result)
+        self.assertValidXmp(output)
+        self.assertEqual(len(output), len(data))
+
+    def test_existing_packet_without_padding_grows(self):
+        data = jpeg(JFIF, segment(0xE1, jpeg_xmp.XMP_SIGNATURE + xmp_packet()))
+        result, output, _ = self.inject(data)
+        self.assertTrue(result)
+        self.assertValidXmp(output)
+        self.assertGreater(len(output), len(data))
+
+    def test_existing_namespace_is_left_for_exiv2(self):
+        packet = xmp_packet(' xmlns:GCamera="{}" GCamera:MicroVideo="1"'.format(NAMESPACE))
+        data = jpeg(JFIF, segment(0xE1, jpeg_xmp.XMP_SIGNATURE + packet))
+        result, output, position = self.inject(data)
+        self.assertFalse(result)
+        self.assertEqual(position, 0)
+        self.assertEqual(output, data)
+
+    def test_segment_size_limit(self):
+        # Fill an existing packet right up to the limit, so adding anything to it can't fit in one segment.
+        packet = xmp_packet()
+        filler = jpeg_xmp.MAX_XMP_PACKET_SIZE - len(packet) + len(b'xmp:Rating="3"') - len(b'xmp:Label=""')
+        packet = packet.replace(b'xmp:Rating="3"', b'xmp:Label="' + b'a' * filler + b'"')
+        self.assertEqual(len(packet), jpeg_xmp.MAX_XMP_PACKET_SIZE)
+        data = jpeg(JFIF, segment(0xE1, jpeg_xmp.XMP_SIGNATURE + packet))
+        result, output, position = self.inject(data)
+        self.assertFalse(result)
+        self.assertEqual(position, 0)
+        self.assertEqual(output, data)
+
+    def test_not_a_jpeg(self):
+        for data in (b'', b'not a jpeg', jpeg_xmp.JPEG_SOI + b'\x00\x00', jpeg_xmp.JPEG_SOI + DQT[:10]):
+            with self.subTest(data=data):
+                result, output, position = self.inject(data)
+                self.assertFalse(result)
+                self.assertEqual(position, 0)
+                self.assertEqual(output, data)
+
+    def test_unmappable_file_is_read_instead(self):
+        data = jpeg(JFIF, DQT)
+        with mock.patch('mmap.mmap', side_effect=OSError(errno.ENODEV, 'No such device')):
+            result, output, _ = self.inject(data)
+        self.assertTrue(result)
+        self.assertValidXmp(output)
+        self.assertTrue(output.endswith(DQT + SCAN))
+
+
+if __name__ == '__main__':
+    unittest.main()